@@ -0,0 +1,10 @@
+import boto3
+from config_loader import load_config
+
+config = load_config()
+
+# Single AWS session shared by all the clients, so credentials, endpoints and connection pools are set up only once
+SESSION = boto3.Session(aws_access_key_id=config['AWS']['AWS_ACCESS_KEY_ID'],
+                        aws_secret_access_key=config['AWS']['AWS_SECRET_ACCESS_KEY'],
+                        region_name='eu-west-1'
+                        )
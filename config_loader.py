@@ -0,0 +1,14 @@
+import configparser
+import functools
+
+
+@functools.lru_cache(maxsize=1)
+def load_config(path='credentials.cfg'):
+    """ Parses the pipeline parameters file once and returns it as a plain dict of sections, e.g.
+    config["DWH"]["DWH_DB"]. The result is cached so every module shares the same parsed copy. """
+    parser = configparser.ConfigParser()
+    # Keep the option names as written in the file rather than lowercasing them
+    parser.optionxform = str
+    with open(path) as f:
+        parser.read_file(f)
+    return {section: dict(parser.items(section)) for section in parser.sections()}
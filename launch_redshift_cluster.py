@@ -1,39 +1,25 @@
 import json
-import time
-import boto3
-import configparser
+from aws_session import SESSION
+from config_loader import load_config
 
+config = load_config()
 
-def launch_redshift_cluster():
-    config = configparser.ConfigParser()
-    config.read_file(open('credentials.cfg'))
-
-    KEY = config.get('AWS', 'AWS_ACCESS_KEY_ID')
-    SECRET = config.get('AWS', 'AWS_SECRET_ACCESS_KEY')
 
-    DWH_CLUSTER_TYPE = config.get("DWH", "DWH_CLUSTER_TYPE")
-    DWH_NUM_NODES = config.get("DWH", "DWH_NUM_NODES")
-    DWH_NODE_TYPE = config.get("DWH", "DWH_NODE_TYPE")
-
-    DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
-    DWH_DB = config.get("DWH", "DWH_DB")
-    DWH_DB_USER = config.get("DWH", "DWH_DB_USER")
-    DWH_DB_PASSWORD = config.get("DWH", "DWH_DB_PASSWORD")
-    DWH_PORT = config.get("DWH", "DWH_PORT")
+def launch_redshift_cluster():
+    DWH_CLUSTER_TYPE = config['DWH']['DWH_CLUSTER_TYPE']
+    DWH_NUM_NODES = config['DWH']['DWH_NUM_NODES']
+    DWH_NODE_TYPE = config['DWH']['DWH_NODE_TYPE']
 
-    DWH_IAM_ROLE_NAME = config.get("DWH", "DWH_IAM_ROLE_NAME")
+    DWH_CLUSTER_IDENTIFIER = config['DWH']['DWH_CLUSTER_IDENTIFIER']
+    DWH_DB = config['DWH']['DWH_DB']
+    DWH_DB_USER = config['DWH']['DWH_DB_USER']
+    DWH_DB_PASSWORD = config['DWH']['DWH_DB_PASSWORD']
+    DWH_PORT = config['DWH']['DWH_PORT']
 
-    iam = boto3.client('iam',
-                       aws_access_key_id=KEY,
-                       aws_secret_access_key=SECRET,
-                       region_name='eu-west-1'
-                       )
+    DWH_IAM_ROLE_NAME = config['DWH']['DWH_IAM_ROLE_NAME']
 
-    redshift = boto3.client('redshift',
-                            region_name="eu-west-1",
-                            aws_access_key_id=KEY,
-                            aws_secret_access_key=SECRET
-                            )
+    iam = SESSION.client('iam')
+    redshift = SESSION.client('redshift')
 
     # CREATE IAM ROLE that enable Redshift to access our S3 bucket
     # Step 1 - Create the IAM Role
@@ -55,9 +41,12 @@ def launch_redshift_cluster():
     # Step 2 - Attach the policy
     print("Attaching AmazonS3ReadOnlyAccess Policy")
 
-    iam.attach_role_policy(RoleName=DWH_IAM_ROLE_NAME,
-                           PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-                          )['ResponseMetadata']['HTTPStatusCode']
+    response = iam.attach_role_policy(RoleName=DWH_IAM_ROLE_NAME,
+                                      PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+                                      )
+    status_code = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    if status_code != 200:
+        raise ValueError(f"Failed to attach policy to IAM role {DWH_IAM_ROLE_NAME}: {response}")
 
     # Step 3 - get the IAM role ARN
     roleArn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
@@ -84,13 +73,12 @@ def launch_redshift_cluster():
     except Exception as e:
         print(e)
 
-    # Retrieve cluster status and wait until it becomes available
-    status = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterStatus']
-    print("Cluster status is:", status, "- Waiting until cluster becomes available")
-    while status != 'available':
-        time.sleep(60)
-        status = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterStatus']
-        print("Cluster status is:", status, "- Waiting until cluster becomes available")
+    # Wait until the cluster becomes available, polling via the built-in boto3 waiter
+    print("Waiting until cluster becomes available")
+    waiter = redshift.get_waiter('cluster_available')
+    waiter.wait(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
+                WaiterConfig={'Delay': 30, 'MaxAttempts': 60}
+                )
     print("Retrieving endpoint and role arn")
     # Once the redshift cluster is available, retrieve endpoint and role arn
     cluster_desc = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
@@ -100,11 +88,7 @@ def launch_redshift_cluster():
     # Open incoming TCP port to access cluster endpoint
     print("Opening incoming TCP port to access cluster endpoint")
     try:
-        ec2 = boto3.resource('ec2',
-                             region_name="eu-west-1",
-                             aws_access_key_id=KEY,
-                             aws_secret_access_key=SECRET
-                             )
+        ec2 = SESSION.resource('ec2')
         vpc = ec2.Vpc(id=cluster_desc['VpcId'])
         default_sg = list(vpc.security_groups.all())[0]
         print(default_sg)
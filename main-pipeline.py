@@ -1,31 +1,77 @@
-import boto3
 import psycopg2
 from pyspark.sql import SparkSession
 from pyspark.sql.types import *
 import pyspark.sql.functions as F
-from pyspark.sql import Window
-import configparser
+from pyspark import StorageLevel
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor
+from aws_session import SESSION
+from config_loader import load_config
 from launch_redshift_cluster import launch_redshift_cluster
 from sql_queries import drop_table_queries, create_table_queries, insert_table_queries, staging_table_copy, \
-    staging_table_drop, staging_table_create, staging_table_filter, sql_check_filled, sql_check_unique_1, \
+    staging_table_drop, staging_table_create, sql_check_filled, sql_check_unique_1, \
     sql_check_unique_2
 
 # Set the AWS environment variables (for S3 access)
-config = configparser.ConfigParser()
-config.read_file(open('credentials.cfg'))
+config = load_config()
 os.environ["AWS_ACCESS_KEY_ID"] = config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ["AWS_SECRET_ACCESS_KEY"] = config['AWS']['AWS_SECRET_ACCESS_KEY']
-s3_bucket = "s3://" + config.get("S3", "S3_BUCKET")
+s3_bucket = "s3://" + config["S3"]["S3_BUCKET"]
+target_category = config["PARAMS"]["CATEGORY"]
+
+# US state code and zipcode at the end of an address, e.g. CA 90210
+US_STATE_ZIP_PATTERN = r'^([A-Z]{2})\s(\d{5})'
+
+# Explicit schemas for the json datasets, so Spark doesn't need an extra pass over the data to infer them.
+# Only the fields used downstream are listed - the others (phone, hours, gps, reviewerName...) are never parsed.
+raw_places_schema = StructType([
+    StructField("gPlusPlaceId", StringType()),
+    StructField("name", StringType()),
+    StructField("price", StringType()),
+    StructField("address", ArrayType(StringType()))
+])
+
+raw_reviews_schema = StructType([
+    StructField("gPlusPlaceId", StringType()),
+    StructField("gPlusUserId", StringType()),
+    StructField("categories", ArrayType(StringType())),
+    StructField("rating", DoubleType()),
+    StructField("reviewText", StringType()),
+    StructField("unixReviewTime", LongType())
+])
+
+prepped_places_schema = StructType([
+    StructField("gPlusPlaceId", StringType()),
+    StructField("name", StringType()),
+    StructField("price", LongType()),
+    StructField("address", StringType()),
+    StructField("state", StringType()),
+    StructField("postcode", StringType()),
+    StructField("country", StringType()),
+    StructField("population", DoubleType())
+])
+
+prepped_reviews_schema = StructType([
+    StructField("gPlusPlaceId", StringType()),
+    StructField("gPlusUserId", StringType()),
+    StructField("categories", ArrayType(StringType())),
+    StructField("rating", DoubleType()),
+    StructField("reviewText", StringType()),
+    StructField("reviewTime", StringType()),
+    StructField("weekday", StringType()),
+    StructField("day_night", StringType()),
+    StructField("userAvgRating", DoubleType())
+])
 
 
 def create_spark_session():
     """ Instantiates a hadoop-based Spark session """
-    # Create Spark session with hadoop-aws package
+    # Create Spark session - S3 access is served by EMRFS on the EMR cluster, so no hadoop-aws package is needed
     spark = SparkSession.builder \
         .appName("CapstonePipeline") \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.scheduler.mode", "FAIR") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.autoBroadcastJoinThreshold", "50MB") \
         .getOrCreate()
     return spark
 
@@ -39,12 +85,17 @@ def to_spark_friendly_json(spark, filename):
      - replaces ASCII encoded values by their unicode equivalent
      """
     text_df = spark.read.text(s3_bucket + "/" + filename + ".json")
-    text_df = (text_df.withColumn('value', F.regexp_replace('value', 'False', 'false'))
-               .withColumn('value', F.regexp_replace('value', 'True', 'true'))
-               .withColumn('value', F.regexp_replace('value', 'None', 'null'))
-               .withColumn('value', F.regexp_replace('value', "u'", "'"))
-               .withColumn('value', F.regexp_replace('value', "u\"", "\""))
-               .withColumn('value', F.regexp_replace('value', r"\\x", r"\\u00")))
+    fixes = [('False', 'false'),
+             ('True', 'true'),
+             ('None', 'null'),
+             ("u'", "'"),
+             ("u\"", "\""),
+             (r"\\x", r"\\u00")]
+    # Nest all the replacements into a single expression so each line is rewritten in one projection
+    value = F.col('value')
+    for pattern, replacement in fixes:
+        value = F.regexp_replace(value, pattern, replacement)
+    text_df = text_df.select(value.alias('value'))
     text_df.write.mode("overwrite").text(s3_bucket + "/fixed/" + filename)
 
 
@@ -56,40 +107,35 @@ def process_places(spark):
     - adds a population column from the us population by postcode csv file
     - saves the dataset in S3 for further processing
     """
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", "places")
     to_spark_friendly_json(spark, "places")
     # about 13000 corrupted records, with no obvious pattern to be fixed. Can be dropped.
-    places_df = spark.read.json(s3_bucket + "/fixed/places", mode="DROPMALFORMED")
-    places_df = places_df.drop("phone", "closed", "gps", "hours")
-
-    def extract_usa(address):
-        """" Takes an array representing an address as input and identifies US addresses by recognising a US zipcode
-        pattern. Returns a string containing the State code and zipcode. e.g. CA 90210 """
-        # if last string in the address contains two isolated capital letters followed by 5 digits,
-        # then the country is USA
-        match = re.search("^[A-Z]{2}\s\d{5}", address[-1].split(sep=', ')[-1])
-        if match is None:
-            return None
-        else:
-            return match.group()
-
-    udf_extract_usa = F.udf(extract_usa, StringType())
-    places_df = places_df.withColumn("state_and_zip_usa", udf_extract_usa(places_df.address))
-    places_df = (places_df
-                 .withColumn("state", F.split(places_df["state_and_zip_usa"], ' ').getItem(0))
-                 .withColumn("postcode", F.split(places_df["state_and_zip_usa"], ' ').getItem(1))
-                 .drop("state_and_zip_usa"))
-    places_df = places_df.withColumn("country", F.when(places_df.state.isNull(), None).otherwise("USA"))
-    places_df = places_df.withColumn("address", F.concat_ws(",", places_df.address))
-
-    # Convert price to integer index - Spark automatically converts the price string to an integer data type. Nice!
-    places_df = places_df.withColumn("price", F.length(places_df.price))
+    places_df = spark.read.schema(raw_places_schema).json(s3_bucket + "/fixed/places", mode="DROPMALFORMED")
+
+    # if last string in the address contains two isolated capital letters followed by 5 digits,
+    # then the country is USA. e.g. CA 90210
+    address_tail = F.element_at(F.split(F.element_at(places_df.address, -1), ', '), -1)
+    state = F.regexp_extract(address_tail, US_STATE_ZIP_PATTERN, 1)
+    state = F.when(state != "", state)
+    postcode = F.regexp_extract(address_tail, US_STATE_ZIP_PATTERN, 2)
+    places_df = places_df.select(
+        "gPlusPlaceId",
+        "name",
+        # Convert price to integer index - Spark automatically converts the price string to an integer data type
+        F.length(places_df.price).alias("price"),
+        F.concat_ws(",", places_df.address).alias("address"),
+        state.alias("state"),
+        F.when(postcode != "", postcode).alias("postcode"),
+        F.when(state.isNull(), None).otherwise("USA").alias("country")
+    )
     # Add population column to the dataset
     pop_df = spark.read.csv(s3_bucket + "/us_population_by_zipcode.csv", header=True)
     pop_df = (pop_df.groupby("Zip Code ZCTA")
                     .agg({"2010 Census Population": "sum"})
                     .select(F.col("sum(2010 Census Population)").alias("population"), "Zip Code ZCTA")
               )
-    places_df = (places_df.join(F.broadcast(pop_df), pop_df['Zip Code ZCTA'] == places_df['postcode'], how="left")
+    # No broadcast hint - adaptive execution broadcasts the aggregated population data only if it is small enough
+    places_df = (places_df.join(pop_df, pop_df['Zip Code ZCTA'] == places_df['postcode'], how="left")
                           .drop('Zip Code ZCTA')
                  )
     places_df.write.json(s3_bucket + "/prepped/places")
@@ -105,23 +151,25 @@ def process_reviews(spark):
     - derives the reviewer's average rating
     - saves the dataset in S3 for further processing
     """
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", "reviews")
     to_spark_friendly_json(spark, "reviews")
-    reviews_df = spark.read.json(s3_bucket + "/fixed/reviews", mode='DROPMALFORMED')
+    reviews_df = spark.read.schema(raw_reviews_schema).json(s3_bucket + "/fixed/reviews", mode='DROPMALFORMED')
     # Convert unixReviewtime from long datatype to unix timestamp
-    reviews_df = (reviews_df.drop("reviewerName")
-                  .withColumn('reviewTime', F.from_unixtime(reviews_df.unixReviewTime).cast(TimestampType()))
-                  # .withColumn('timeOfReview', reviews_df['timeOfReview'].cast(TimestampType()))
-                  .withColumn('weekday', F.date_format(F.col("reviewTime"), "E")))
-    reviews_df = (reviews_df
-                  .withColumn('day_night',
-                              F.when((F.hour(reviews_df.reviewTime) < 8) | (F.hour(reviews_df.reviewTime) >= 18),
-                                     'night')
-                              .when((F.hour(reviews_df.reviewTime) >= 8) | (F.hour(reviews_df.reviewTime) < 18), 'day')
-                              .otherwise(None))
-                  # derive the user's average review rating to a new column
-                  .withColumn("userAvgRating", F.avg("rating").over(Window.partitionBy("gPlusUserId")))
-                  .drop("unixReviewTime")
-                  )
+    review_time = F.from_unixtime(reviews_df.unixReviewTime).cast(TimestampType())
+    reviews_df = reviews_df.select(
+        "gPlusPlaceId",
+        "gPlusUserId",
+        "categories",
+        "rating",
+        "reviewText",
+        review_time.alias('reviewTime'),
+        F.date_format(review_time, "E").alias('weekday'),
+        # day is 8am-6pm, night is 6pm-8am - reviews without a timestamp are left null
+        F.when(F.hour(review_time).between(8, 17), 'day').when(review_time.isNotNull(), 'night').alias('day_night')
+    )
+    # derive the user's average review rating and join it back to a new column - AQE decides whether to broadcast it
+    user_avg_df = reviews_df.groupBy("gPlusUserId").agg(F.avg("rating").alias("userAvgRating"))
+    reviews_df = reviews_df.join(user_avg_df, "gPlusUserId", how="left")
     reviews_df.write.json(s3_bucket + "/prepped/reviews")
     return None
 
@@ -129,49 +177,56 @@ def process_reviews(spark):
 def create_data_lake(spark):
     """ Joins the reviews and places datasets into one large Data Lake containing only US-based reviews and
     loads it to S3 as parquet files partitioned by business category. Also filters out the review text and loads a
-    non-partitioned staging data lake into S3 for further processing. """
+    staging data lake partitioned by category bucket into S3 for further processing. """
 
-    reviews_df = spark.read.json(s3_bucket + "/prepped/reviews")
-    places_df = spark.read.json(s3_bucket + "/prepped/places")
+    reviews_df = spark.read.schema(prepped_reviews_schema).json(s3_bucket + "/prepped/reviews")
+    places_df = spark.read.schema(prepped_places_schema).json(s3_bucket + "/prepped/places")
     # Drop reviews with missing categories
     reviews_df = reviews_df.filter(reviews_df.categories.isNotNull())
     # Keep only USA places
     places_df = places_df.filter(places_df.country == "USA")
-    # Join reviews with places into a single dataset
-    lake = reviews_df.join(places_df, "gPlusPlaceId", how="inner")
+    # Join reviews with places into a single dataset - cached so the checks and both parquet writes below don't
+    # re-read the json datasets and recompute the join
+    joined_lake = reviews_df.join(places_df, "gPlusPlaceId", how="inner").persist(StorageLevel.MEMORY_AND_DISK)
     # Check join was successful and no larger than expected
     reviews_count = reviews_df.count()
-    lake_count = lake.count()
+    lake_count = joined_lake.count()
     if lake_count > reviews_count:
         raise ValueError("Join resulted in too many rows")
 
     # Flatten categories column
-    lake = (lake.withColumn("categories", F.explode(F.col("categories")))
+    lake = (joined_lake.withColumn("categories", F.explode(F.col("categories")))
                 .withColumnRenamed("categories", "category")
             )
-    # Filter out reviews for rare categories
-    pre_filter_count = lake.select("category").distinct().count()
-    lake = lake.withColumn("num_reviews_for_cat", F.count("gPlusPlaceId").over(Window.partitionBy("category")))
-    lake = (lake.filter(lake.num_reviews_for_cat > 10)
-                .drop("num_reviews_for_cat")
-            )
-    post_filter_count = lake.select("category").distinct().count()
+    # Filter out reviews for rare categories - the per category counts are small, so they are cached for the checks
+    # and broadcast to filter the lake without reshuffling the reviews
+    cat_counts = lake.groupBy("category").count().persist()
+    frequent_cats = cat_counts.filter(F.col("count") > 10).select("category")
+    pre_filter_count = cat_counts.count()
+    post_filter_count = frequent_cats.count()
     if post_filter_count >= pre_filter_count:
         raise ValueError("Categories were incorrectly filtered")
+    # Check there is data to write out to the parquet files
+    if post_filter_count == 0:
+        raise ValueError("Data lakes were not populated")
+    # Check the staging lake will have a partition for the Redshift categories to be copied from
+    if frequent_cats.filter(F.col("category").contains(target_category)).count() == 0:
+        raise ValueError(f"No frequent category matches {target_category}, the staging data lake would be empty")
+    lake = lake.join(F.broadcast(frequent_cats), "category", how="inner")
 
     # Write to S3
     lake.write.partitionBy('category').parquet(s3_bucket + "/reviews_lake")
-    lake.select("gPlusPlaceId", "category", "day_night", "gPlusUserId", "rating", "reviewTime",
-                "userAvgRating", "weekday", "address", "country", "name", "population", "postcode",
-                "price", "state").write.parquet(s3_bucket + "/temp_lake")
-
-    # Check data was written out to parquet files
-    reviews_lake = spark.read.parquet(s3_bucket + "/reviews_lake")
-    count_reviews = reviews_lake.count()
-    temp_lake = spark.read.parquet(s3_bucket + "/temp_lake")
-    count_temp = temp_lake.count()
-    if count_reviews == 0 or count_temp == 0:
-        raise ValueError("Data lakes were not populated")
+    # The staging lake can't simply be replaced by reviews_lake: Redshift's parquet COPY maps columns by position, so
+    # it would pick up reviewText and miss category, which only exists in the reviews_lake partition paths.
+    # It is partitioned by a separate cat_bucket column instead, so Redshift only copies the relevant categories
+    # Fixed bucket values, so the S3 path doesn't depend on how Spark escapes the configured category name
+    cat_bucket = F.when(F.col("category").contains(target_category), "match").otherwise("other")
+    (lake.select("gPlusPlaceId", "category", "day_night", "gPlusUserId", "rating", "reviewTime",
+                 "userAvgRating", "weekday", "address", "country", "name", "population", "postcode",
+                 "price", "state", cat_bucket.alias("cat_bucket"))
+         .write.partitionBy("cat_bucket").parquet(s3_bucket + "/temp_lake"))
+    joined_lake.unpersist()
+    cat_counts.unpersist()
 
 
 def load_staging_table(cur, conn, arn):
@@ -182,6 +237,7 @@ def load_staging_table(cur, conn, arn):
         cur.execute(staging_table_drop)
         conn.commit()
     except Exception as err:
+        conn.rollback()
         print(err)
     # create fresh staging table
     print("Creating staging table")
@@ -189,46 +245,39 @@ def load_staging_table(cur, conn, arn):
         cur.execute(staging_table_create)
         conn.commit()
     except Exception as e:
+        conn.rollback()
         print(e)
-    # copy staging table from full s3 datalake
-    print("Copying staging table from S3 location: {}".format(s3_bucket + "/temp_lake"))
+    # copy staging table from the s3 datalake partition holding the relevant categories
+    staging_lake = s3_bucket + "/temp_lake/cat_bucket=match/"
+    print("Copying staging table from S3 location: {}".format(staging_lake))
     try:
-        cur.execute(staging_table_copy.format(s3_bucket + "/temp_lake", arn))
+        cur.execute(staging_table_copy.format(staging_lake, arn))
         conn.commit()
     except Exception as e:
+        # leave the connection usable for the following steps
+        conn.rollback()
         print(e)
-    # filter staging table to keep only the relevant categories
-    print("Filtering irrelevant categories from staging table")
+
+
+def execute_in_transaction(cur, conn, queries):
+    """ Executes a list of queries as a single transaction, committed once at the end or rolled back on error """
     try:
-        cur.execute(staging_table_filter)
+        for query in queries:
+            cur.execute(query)
         conn.commit()
     except Exception as err:
+        conn.rollback()
         print(err)
 
 
 def load_final_tables(cur, conn):
     """ Loads the fact and dimension tables with data from the staging table """
     # drop all Redshift tables if they exist already
-    for query in drop_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except Exception as err:
-            print(err)
+    execute_in_transaction(cur, conn, drop_table_queries)
     # create final table for star schema
-    for query in create_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except Exception as err:
-            print(err)
+    execute_in_transaction(cur, conn, create_table_queries)
     # load tables
-    for query in insert_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except Exception as err:
-            print(err)
+    execute_in_transaction(cur, conn, insert_table_queries)
 
 
 def check_data_quality(cur, tables, table_keys):
@@ -261,20 +310,31 @@ def drop_staging_table(cur, conn):
         print(err)
 
 
+def delete_s3_prefix(s3, bucket, prefix):
+    """ Deletes all the objects under a prefix of an S3 bucket, in batches of up to 1000 keys per request """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        # list_objects_v2 pages hold at most 1000 keys, the delete_objects limit
+        keys = [{'Key': file['Key']} for file in page.get('Contents', [])]
+        if keys:
+            print('Deleting', len(keys), 'files from', prefix)
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+            # delete_objects doesn't raise when individual keys fail, it lists them under Errors instead
+            errors = response.get('Errors', [])
+            if errors:
+                failed = ", ".join(f"{error['Key']} ({error['Code']}: {error['Message']})" for error in errors)
+                raise ValueError(f"Failed to delete {len(errors)} files from {prefix}: {failed}")
+
+
 def clear_temp_data():
     """ Connects to s3 and deletes the fixed input files as well as the temporary data lake """
-    # Clear temp data lake from s3
-    s3 = boto3.client('s3')
-    bucket = config.get("S3", "S3_BUCKET")
-    temp_lake = s3.list_objects_v2(Bucket=bucket, Prefix="temp_lake/")
-    for file in temp_lake['Contents']:
-        print('Deleting', file['Key'])
-        s3.delete_object(Bucket=bucket, Key=file['Key'])
-    # Clear temp cleaned input files from s3
-    fixed_files = s3.list_objects_v2(Bucket=bucket, Prefix="fixed/")
-    for file in fixed_files['Contents']:
-        print('Deleting', file['Key'])
-        s3.delete_object(Bucket=bucket, Key=file['Key'])
+    s3 = SESSION.client('s3')
+    bucket = config["S3"]["S3_BUCKET"]
+    # Clear temp data lake and temp cleaned input files from s3
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        jobs = [executor.submit(delete_s3_prefix, s3, bucket, prefix) for prefix in ("temp_lake/", "fixed/")]
+        for job in jobs:
+            job.result()
 
 
 def main():
@@ -283,16 +343,18 @@ def main():
      - transforms, filters and enriches the reviews and places data
      - creates two data lakes:
             - a reviews data lake that contains reviews for all the places in the USA, partitioned by category
-            - a temporary data lake (unpartitioned) used to load a Redshift table
+            - a temporary data lake (partitioned by category bucket) used to load a Redshift table
      - launches a Redshift cluster
      - creates a database of USA restaurant reviews
      - checks database tables have been filled
      - clears the temporary files and data lake
      """
     spark = create_spark_session()
-    # Extract and transform places and reviews data
-    process_places(spark)
-    process_reviews(spark)
+    # Extract and transform places and reviews data - independent jobs, so run them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        jobs = [executor.submit(process, spark) for process in (process_places, process_reviews)]
+        for job in jobs:
+            job.result()  # re-raises any exception from the spark job
     # Load data lakes
     create_data_lake(spark)
     spark.stop()  # ensures the application isn't left hanging at the end of the batch spark job
@@ -301,10 +363,10 @@ def main():
     host, arn = launch_redshift_cluster()
     # Connect to the Redshift database cluster
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(host,
-                                                                                   config.get("DWH", "DWH_DB"),
-                                                                                   config.get("DWH", "DWH_DB_USER"),
-                                                                                   config.get("DWH", "DWH_DB_PASSWORD"),
-                                                                                   config.get("DWH", "DWH_PORT"))
+                                                                                   config["DWH"]["DWH_DB"],
+                                                                                   config["DWH"]["DWH_DB_USER"],
+                                                                                   config["DWH"]["DWH_DB_PASSWORD"],
+                                                                                   config["DWH"]["DWH_PORT"])
                             )
     cur = conn.cursor()
     print("Connected to Redshift")
@@ -1,9 +1,3 @@
-import configparser
-
-# Retrieve parameters
-config = configparser.ConfigParser()
-config.read('credentials.cfg')
-
 # Drop tables
 staging_table_drop = "DROP TABLE IF EXISTS staging"
 users_table_drop = "DROP TABLE IF EXISTS users"
@@ -37,10 +31,6 @@ staging_table_copy = ("""COPY staging FROM '{}'
                             FORMAT AS PARQUET;"""
                       )
 
-staging_table_filter = (""" DELETE FROM staging
-                            WHERE category NOT LIKE '%{}%'; """
-                        ).format(config.get("PARAMS", "CATEGORY"))
-
 # Create final tables
 
 users_table_create = ("""